@@ -1,9 +1,17 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 
 from .jellysync import JellySync
 
 
+def positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -30,6 +38,17 @@ def main():
         help="Do a dry run without downloading",
         action="store_true",
     )
+    parser.add_argument(
+        "--concurrency",
+        help="The number of episodes to download at once, e.g. 4",
+        type=positive_int,
+        default=4,
+    )
+    parser.add_argument(
+        "--no-progress",
+        help="Do not display download progress bars",
+        action="store_true",
+    )
 
     subparsers = parser.add_subparsers(title="subcommands", required=True)
 
@@ -52,20 +71,24 @@ def main():
     )
 
     args = parser.parse_args()
+    asyncio.run(run(args))
+
 
-    jelly_sync = JellySync(
+async def run(args: argparse.Namespace):
+    async with JellySync(
         args.host_url,
         args.api_key,
         args.media_dir,
         args.use_content_disposition,
         args.dry_run,
-    )
-
-    if args.cmd == "download-series":
-        jelly_sync.download_series(args.series_id)
+        args.concurrency,
+        not args.no_progress,
+    ) as jelly_sync:
+        if args.cmd == "download-series":
+            await jelly_sync.download_series(args.series_id)
 
-    if args.cmd == "download-season":
-        jelly_sync.download_season(args.series_id, args.season_id)
+        if args.cmd == "download-season":
+            await jelly_sync.download_season(args.series_id, args.season_id)
 
 
 if __name__ == "__main__":
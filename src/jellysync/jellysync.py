@@ -1,29 +1,119 @@
 #!/usr/bin/env python3
+import asyncio
 import os
-from dataclasses import dataclass
-from email.message import EmailMessage
+import re
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, ClassVar
+from urllib.parse import unquote
 
 import httpx
+import orjson
 from pathvalidate import sanitize_filepath
 from rich import print
+from rich.markup import escape
 from rich.progress import (
     BarColumn,
     FileSizeColumn,
     Progress,
+    TaskID,
     TaskProgressColumn,
     TextColumn,
     TimeRemainingColumn,
     TotalFileSizeColumn,
     TransferSpeedColumn,
 )
-from rich.text import Text
+
+# Only Id, Name, SeriesName, ParentIndexNumber, IndexNumber and Container are
+# read from items, and Jellyfin always returns those, so no optional fields are
+# requested and the image and user data lookups are turned off
+ITEM_QUERY = {"enableImages": "false", "enableUserData": "false"}
+
+FILENAME_RE = re.compile(r'filename\s*=\s*(?:"([^"]*)"|([^;]*))', re.IGNORECASE)
+EXT_FILENAME_RE = re.compile(r"filename\*\s*=\s*([^']*)'[^']*'([^;]*)", re.IGNORECASE)
 
 
 def parse_filename(content_disposition: str) -> str:
-    msg = EmailMessage()
-    msg["content-type"] = content_disposition
-    params = msg["content-type"].params
-    return sanitize_filepath(params["filename"])
+    if match := EXT_FILENAME_RE.search(content_disposition):
+        charset, value = match.groups()
+        filename = unquote(value.strip(), encoding=charset or "utf-8")
+    elif match := FILENAME_RE.search(content_disposition):
+        quoted, token = match.groups()
+        filename = quoted if quoted is not None else token.strip()
+    else:
+        raise ValueError(f"No filename in Content-Disposition: {content_disposition}")
+    return sanitize_filepath(filename)
+
+
+def scan_filesizes(folder: str) -> dict[str, int]:
+    try:
+        with os.scandir(folder) as entries:
+            return {
+                entry.name: entry.stat().st_size for entry in entries if entry.is_file()
+            }
+    except FileNotFoundError:
+        return {}
+
+
+@dataclass
+class ProgressWriter:
+    fp: BinaryIO
+    progress: Progress
+    task_id: TaskID
+    batch_size: int
+    interval: float
+    pending: int = 0
+    last_update: float = field(default_factory=time.monotonic)
+
+    def write(self, data: bytes) -> int:
+        written = self.fp.write(data)
+        self.pending += written
+        now = time.monotonic()
+        if self.pending >= self.batch_size or now - self.last_update > self.interval:
+            self.progress.update(self.task_id, advance=self.pending)
+            self.pending = 0
+            self.last_update = now
+        return written
+
+    def flush(self):
+        self.fp.flush()
+        if self.pending:
+            self.progress.update(self.task_id, advance=self.pending)
+            self.pending = 0
+
+
+@dataclass
+class CacheDroppingWriter:
+    fp: BinaryIO
+    window: int
+    offset: int = 0
+    advised: int = 0
+
+    def write(self, data: bytes) -> int:
+        written = self.fp.write(data)
+        self.offset += written
+        if self.offset - self.advised >= self.window:
+            self.drop_cache()
+        return written
+
+    def flush(self):
+        self.fp.flush()
+        if self.offset > self.advised:
+            self.drop_cache()
+
+    def drop_cache(self):
+        # Downloads are written once and not read back, so keep them from
+        # evicting the rest of the page cache. DONTNEED skips dirty pages, so
+        # the range has to reach the disk before it can be dropped.
+        self.fp.flush()
+        os.fdatasync(self.fp.fileno())
+        os.posix_fadvise(
+            self.fp.fileno(),
+            self.advised,
+            self.offset - self.advised,
+            os.POSIX_FADV_DONTNEED,
+        )
+        self.advised = self.offset
 
 
 @dataclass
@@ -33,108 +123,273 @@ class JellySync:
     media_dir: str | None
     use_content_disposition: bool
     dry_run: bool
+    concurrency: int = 4
+    show_progress: bool = True
+
+    CHUNK_SIZE: ClassVar[int] = 1 << 20
+    PROGRESS_BYTES: ClassVar[int] = 4 << 20
+    PROGRESS_INTERVAL: ClassVar[float] = 0.1
+    FADVISE_BYTES: ClassVar[int] = 64 << 20
 
     def __post_init__(self):
-        if self.media_dir:
-            os.chdir(self.media_dir)
+        self._media_root = os.path.abspath(self.media_dir or os.curdir)
+        if not os.path.isdir(self._media_root):
+            raise NotADirectoryError(f"Media directory not found: {self._media_root}")
+        self._headers = {
+            "Authorization": f'MediaBrowser Client="jelly-sync", Token="{self.api_key}"'
+        }
+        self._client = httpx.AsyncClient(
+            http2=True,
+            headers=self._headers,
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=httpx.Timeout(30, read=None),
+        )
+        self._created_dirs: set[str] = set()
+        self._active_downloads: set[str] = set()
+        self._filesizes: dict[str, dict[str, int]] = {}
+        self._season_dirs: dict[tuple[str, int], str] = {}
 
-    def download_series(self, series_id: str):
-        seasons = self.get_seasons(series_id)
-        for season in seasons:
-            self.download_season(series_id, season["Id"])
+    async def __aenter__(self):
+        return self
 
-    def download_season(self, series_id: str, season_id: str):
-        episodes = self.get_episodes(series_id, season_id)
-        self.download_items(episodes)
+    async def __aexit__(self, *exc_info):
+        await self._client.aclose()
 
-    def get_auth_header(self) -> dict[str, str]:
-        return {
-            "Authorization": f'MediaBrowser Client="jelly-sync", Token="{self.api_key}"'
-        }
+    async def download_series(self, series_id: str):
+        seasons = await self.get_seasons(series_id)
+        season_episodes = await asyncio.gather(
+            *(self.get_episodes(series_id, season["Id"]) for season in seasons)
+        )
+        await self.download_items(
+            [episode for episodes in season_episodes for episode in episodes]
+        )
+
+    async def download_season(self, series_id: str, season_id: str):
+        episodes = await self.get_episodes(series_id, season_id)
+        await self.download_items(episodes)
 
-    def get_seasons(self, series_id: str):
+    async def get_seasons(self, series_id: str):
         url = f"{self.host_url}/Shows/{series_id}/Seasons"
-        resp = httpx.get(url, headers=self.get_auth_header())
-        data = resp.json()
+        resp = await self._client.get(url, params=ITEM_QUERY)
+        data = orjson.loads(resp.content)
         return data["Items"]
 
-    def get_episodes(self, series_id: str, season_id: str):
-        url = f"{self.host_url}/Shows/{series_id}/Episodes?seasonId={season_id}"
-        resp = httpx.get(url, headers=self.get_auth_header())
-        data = resp.json()
+    async def get_episodes(self, series_id: str, season_id: str):
+        url = f"{self.host_url}/Shows/{series_id}/Episodes"
+        resp = await self._client.get(url, params={"seasonId": season_id, **ITEM_QUERY})
+        data = orjson.loads(resp.content)
         return data["Items"]
 
-    def download_items(self, items):
-        for item in items:
-            download_url = self.make_download_url(item)
-            output_path = self.make_file_path(item)
-            self.download(download_url, output_path)
+    async def download_items(self, items):
+        downloads = [
+            (self.make_download_url(item), self.make_file_path(item)) for item in items
+        ]
+        folders = {os.path.dirname(filename) for _, filename in downloads}
+        await asyncio.gather(*(self.scan_folder(folder) for folder in folders))
+        if not self.dry_run and not self.use_content_disposition:
+            await asyncio.gather(*(self.ensure_folder(folder) for folder in folders))
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            TaskProgressColumn(),
+            TimeRemainingColumn(),
+            TextColumn("remaining"),
+            FileSizeColumn(),
+            TextColumn("of"),
+            TotalFileSizeColumn(),
+            TextColumn("at"),
+            TransferSpeedColumn(),
+            transient=False,
+            disable=not self.show_progress,
+        ) as progress:
+            async with asyncio.TaskGroup() as tg:
+                for url, filename in downloads:
+                    tg.create_task(
+                        self.download_item(url, filename, semaphore, progress)
+                    )
+
+    async def download_item(
+        self,
+        url: str,
+        filename: str,
+        semaphore: asyncio.Semaphore,
+        progress: Progress,
+    ):
+        async with semaphore:
+            task = progress.add_task(os.path.basename(filename), start=False)
+            try:
+                await self.download(url, filename, progress, task)
+            finally:
+                progress.remove_task(task)
+
+    async def scan_folder(self, folder: str) -> dict[str, int]:
+        if folder not in self._filesizes:
+            self._filesizes[folder] = await asyncio.to_thread(scan_filesizes, folder)
+        return self._filesizes[folder]
+
+    async def ensure_folder(self, folder: str):
+        if folder not in self._created_dirs:
+            await asyncio.to_thread(os.makedirs, folder, exist_ok=True)
+            self._created_dirs.add(folder)
+
+    async def get_existing_filesize(self, filename: str) -> int | None:
+        folder, name = os.path.split(filename)
+        filesizes = await self.scan_folder(folder)
+        return filesizes.get(name)
 
     def make_download_url(self, item):
         return f"{self.host_url}/Items/{item['Id']}/Download"
 
-    def download(self, url: str, filename: str):
-        with httpx.stream("GET", url, headers=self.get_auth_header()) as resp:
-            if self.use_content_disposition:
-                filename = parse_filename(resp.headers["Content-Disposition"])
-            filesize = int(resp.headers["Content-Length"])
-
-            if os.path.isfile(filename):
-                existing_filesize = os.stat(filename).st_size
-                if filesize == existing_filesize:
-                    text = Text()
-                    text.append("Skipping ", style="bold red")
-                    text.append(filename, style="bold")
-                    text.append(" because file already exists", style="bold blue")
-                    print(text)
+    async def download(self, url: str, filename: str, progress: Progress, task: TaskID):
+        # A HEAD request is only worth it when its headers can let us skip or
+        # resume the download; a missing file is fetched straight away.
+        if (
+            self.use_content_disposition
+            or self.dry_run
+            or await self.get_existing_filesize(filename) is not None
+            or await self.get_existing_filesize(filename + ".part")
+        ):
+            head = await self._client.head(url)
+            if head.status_code != httpx.codes.METHOD_NOT_ALLOWED:
+                target = await self.check_download(head.headers, filename)
+                if target:
+                    await self.fetch_download(url, *target, progress, task)
+                return
+
+        async with self._client.stream("GET", url) as resp:
+            target = await self.check_download(resp.headers, filename)
+            if target:
+                await self.save_download(resp, *target, progress, task)
+
+    async def check_download(
+        self, headers: httpx.Headers, filename: str
+    ) -> tuple[str, int] | None:
+        if self.use_content_disposition:
+            filename = os.path.join(
+                self._media_root, parse_filename(headers["Content-Disposition"])
+            )
+        filesize = int(headers["Content-Length"])
+
+        existing_filesize = await self.get_existing_filesize(filename)
+        if filesize == existing_filesize:
+            print(
+                f"[bold red]Skipping[/] [bold]{escape(filename)}[/]"
+                " [bold blue]because file already exists[/]"
+            )
+            return None
+
+        if self.dry_run:
+            print(
+                f"[bold red]Skipping[/] [bold]{escape(filename)}[/]"
+                " [bold blue]because dry-run flag is set[/]"
+            )
+            return None
+
+        return filename, filesize
+
+    async def fetch_download(
+        self,
+        url: str,
+        filename: str,
+        filesize: int,
+        progress: Progress,
+        task: TaskID,
+    ):
+        offset = await self.get_existing_filesize(filename + ".part") or 0
+        if 0 < offset < filesize:
+            headers = {"Range": f"bytes={offset}-"}
+            async with self._client.stream("GET", url, headers=headers) as resp:
+                content_range = f"bytes {offset}-{filesize - 1}/{filesize}"
+                if (
+                    resp.status_code == httpx.codes.PARTIAL_CONTENT
+                    and resp.headers.get("Content-Range") == content_range
+                ):
+                    await self.save_download(
+                        resp, filename, filesize, progress, task, offset
+                    )
                     return
 
-            if self.dry_run:
-                text = Text()
-                text.append("Skipping ", style="bold red")
-                text.append(filename, style="bold")
-                text.append(" because dry-run flag is set", style="bold blue")
-                print(text)
-                return
+        async with self._client.stream("GET", url) as resp:
+            await self.save_download(resp, filename, filesize, progress, task)
 
-            text = Text()
-            text.append("Downloading ", style="bold green")
-            text.append(filename, style="bold")
-            print(text)
-
-            folder = os.path.dirname(filename)
-            if folder:
-                os.makedirs(folder, exist_ok=True)
-
-            with open(filename, "wb") as fp:
-                with Progress(
-                    TextColumn("[progress.description]{task.description}"),
-                    BarColumn(),
-                    TaskProgressColumn(),
-                    TimeRemainingColumn(),
-                    TextColumn("remaining"),
-                    FileSizeColumn(),
-                    TextColumn("of"),
-                    TotalFileSizeColumn(),
-                    TextColumn("at"),
-                    TransferSpeedColumn(),
-                ) as progress:
-                    task = progress.add_task("Downloading", total=filesize)
-                    for bytes in resp.iter_bytes():
-                        progress.update(task, advance=len(bytes))
-                        fp.write(bytes)
+    async def save_download(
+        self,
+        resp: httpx.Response,
+        filename: str,
+        filesize: int,
+        progress: Progress,
+        task: TaskID,
+        offset: int = 0,
+    ):
+        # Names taken from Content-Disposition can repeat across seasons, and two
+        # downloads sharing a .part file would corrupt each other
+        if filename in self._active_downloads:
+            print(
+                f"[bold red]Skipping[/] [bold]{escape(filename)}[/]"
+                " [bold blue]because it is already being downloaded[/]"
+            )
+            return
+        self._active_downloads.add(filename)
+        try:
+            action = "Resuming" if offset else "Downloading"
+            print(f"[bold green]{action}[/] [bold]{escape(filename)}[/]")
+
+            # Season folders are created up front by download_items, this only
+            # matters for names taken from Content-Disposition
+            await self.ensure_folder(os.path.dirname(filename))
+
+            # Write to a side file so an interrupted download never looks complete
+            partname = filename + ".part"
+            with await asyncio.to_thread(
+                open, partname, "ab" if offset else "wb", buffering=self.CHUNK_SIZE
+            ) as fp:
+                writer = fp
+                if hasattr(os, "posix_fadvise"):
+                    writer = CacheDroppingWriter(
+                        writer, self.FADVISE_BYTES, offset=offset, advised=offset
+                    )
+                if not progress.disable:
+                    progress.update(
+                        task,
+                        description=os.path.basename(filename),
+                        total=filesize,
+                        completed=offset,
+                    )
+                    progress.start_task(task)
+                    writer = ProgressWriter(
+                        writer,
+                        progress,
+                        task,
+                        self.PROGRESS_BYTES,
+                        self.PROGRESS_INTERVAL,
+                    )
+                async for chunk in resp.aiter_bytes(chunk_size=self.CHUNK_SIZE):
+                    await asyncio.to_thread(writer.write, chunk)
+                await asyncio.to_thread(writer.flush)
+            await asyncio.to_thread(os.replace, partname, filename)
+        finally:
+            self._active_downloads.discard(filename)
+        folder, name = os.path.split(filename)
+        self._filesizes.setdefault(folder, {})[name] = filesize
 
     def make_file_path(self, item):
         # TODO: Handle movies
         series = item["SeriesName"]
-        episode_id = f"S{item['ParentIndexNumber']:02d}E{item['IndexNumber']:02d}"
-        title = item["Name"]
-        ext = item["Container"].split(",")[0]
-        return sanitize_filepath(
-            os.path.join(
-                "Shows",
-                series,
-                f"Season {item['ParentIndexNumber']:02d}",
-                f"{series} - {episode_id} - {title}.{ext}",
+        season = item["ParentIndexNumber"]
+        season_dir = self._season_dirs.get((series, season))
+        if season_dir is None:
+            season_dir = os.path.join(
+                self._media_root,
+                sanitize_filepath(
+                    os.path.join("Shows", series, f"Season {season:02d}")
+                ),
             )
+            self._season_dirs[series, season] = season_dir
+        episode_id = f"S{season:02d}E{item['IndexNumber']:02d}"
+        title = item["Name"]
+        ext = item["Container"].partition(",")[0]
+        return os.path.join(
+            season_dir, sanitize_filepath(f"{series} - {episode_id} - {title}.{ext}")
         )